@@ -90,7 +90,10 @@ def run_analyzers(args: argparse.Namespace):
     )
     sys.path = sys.path[:-1]
     log.info("Created %s", manager)
-    listener = EventListener(address=args.server, handlers=manager, n_workers=args.workers)
+    listener = EventListener(address=args.server, handlers=manager, n_workers=args.workers,
+                             queue_size=args.queue_size, inline_handlers=not args.offload_handlers,
+                             n_handler_workers=args.handler_workers,
+                             max_pending_pushes=args.max_pending_pushes)
     log.info("Created %s", listener)
     listener.start()
     log.info("Listening %s", args.server)
@@ -191,6 +194,19 @@ def create_parser() -> configargparse.ArgParser:
                    help="Lookout server address, e.g. localhost:1234.")
     run_parser.add("-w", "--workers", type=int, default=1,
                    help="Number of threads which process Lookout events.")
+    run_parser.add("--queue-size", type=int, default=None,
+                   help="Number of Lookout events which may wait for a free worker before the "
+                        "new ones are rejected. The default is 4 * --workers.")
+    run_parser.add("--offload-handlers", action="store_true",
+                   help="Run the analyzers in a separate thread pool instead of the threads "
+                        "which receive Lookout events.")
+    run_parser.add("--handler-workers", type=int, default=None,
+                   help="Number of threads which run the analyzers with --offload-handlers. "
+                        "The default is the number of CPU cores.")
+    run_parser.add("--max-pending-pushes", type=int, default=0,
+                   help="Acknowledge push events before they are processed and keep at most "
+                        "this number of them pending. 0 means that push events are answered "
+                        "after they are processed.")
     add_model_repository_args(run_parser)
     run_parser.add_argument("--request-server", default="auto",
                             help="Address of the data retrieval service. \"same\" means --server.")
@@ -1,12 +1,16 @@
-from concurrent.futures import ThreadPoolExecutor
-import functools
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
 import logging
-from threading import Event
+from operator import attrgetter
+import os
+from queue import Empty, Queue
+from threading import Barrier, BoundedSemaphore, Event, Thread
 import time
-from typing import Any, Dict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import weakref
 
 import grpc
-import stringcase
+from lookout.sdk.grpc import grpc_max_msg_size
 
 from lookout.core import slogging
 from lookout.core.api.event_pb2 import PushEvent, ReviewEvent
@@ -15,25 +19,49 @@ from lookout.core.api.service_analyzer_pb2_grpc import (add_AnalyzerServicer_to_
                                                         AnalyzerServicer)
 from lookout.core.metrics import record_event
 
+# The clock which measures the processing time and the factor to convert its values to seconds.
+try:
+    _clock, _CLOCK_SCALE = time.perf_counter_ns, 1e-9
+except AttributeError:  # Python < 3.7
+    _clock, _CLOCK_SCALE = time.perf_counter, 1.0
+
+# Returned when there is nothing to answer. gRPC only serializes it so it is never modified.
+_EMPTY_RESPONSE = EventResponse()
+
+
+_get_review_event_context = attrgetter(
+    "commit_revision.base.internal_repository_url",
+    "commit_revision.head.internal_repository_url",
+    "commit_revision.base.hash",
+    "commit_revision.head.hash",
+)
+_get_push_event_context = attrgetter(
+    "commit_revision.head.internal_repository_url",
+    "commit_revision.head.hash",
+    "distinct_commits",
+)
+
 
 def extract_review_event_context(request: ReviewEvent) -> Dict[str, Any]:
     """Extract a structured logging context from the review event."""
+    url_base, url_head, commit_base, commit_head = _get_review_event_context(request)
     return {
         "type": "ReviewEvent",
-        "url_base": request.commit_revision.base.internal_repository_url,
-        "url_head": request.commit_revision.head.internal_repository_url,
-        "commit_base": request.commit_revision.base.hash,
-        "commit_head": request.commit_revision.head.hash,
+        "url_base": url_base,
+        "url_head": url_head,
+        "commit_base": commit_base,
+        "commit_head": commit_head,
     }
 
 
 def extract_push_event_context(request: PushEvent) -> Dict[str, Any]:
     """Extract a structured logging context from the push event."""
+    url, head, count = _get_push_event_context(request)
     return {
         "type": "PushEvent",
-        "url": request.commit_revision.head.internal_repository_url,
-        "head": request.commit_revision.head.hash,
-        "count": request.distinct_commits,
+        "url": url,
+        "head": head,
+        "count": count,
     }
 
 
@@ -43,9 +71,21 @@ request_log_context_extractors = {
 }
 
 
+class TooManyPendingEventsError(Exception):
+    """
+    Raised when an event cannot be scheduled for background processing because the limit of \
+    pending events has been reached.
+    """
+
+
 class EventHandlers:
     """
     Interface of the classes which process Lookout gRPC events.
+
+    The push events which are processed in the background (see `max_pending_pushes` in \
+    EventListener) are grouped by repository. Each group is passed to the optional \
+    `process_push_event_batch(requests)` method if the class defines it, so that the events \
+    can share the work; otherwise, `process_push_event()` is called for each event.
     """
 
     def process_review_event(self, request: ReviewEvent) -> EventResponse:  # noqa: D401
@@ -65,8 +105,8 @@ class EventListener(AnalyzerServicer):
     """
     gRPC ninja which listens to the events coming from the Lookout server.
 
-    So far it supports two events: NotifyReviewEvent and NotifyPushEvent. Both receivers are \
-    decorated heavily to reduce the amount of duplicated code to zero.
+    So far it supports two events: NotifyReviewEvent and NotifyPushEvent. Both receivers \
+    share the same straight-line processing routine to keep the per-call overhead low.
 
     Usage:
 
@@ -75,29 +115,94 @@ class EventListener(AnalyzerServicer):
 
     gRPC calls are operated in a separate thread pool. Thus the main thread has nothing to do \
     and needs to be suspended.
+
+    The metrics are not reported in the gRPC threads: they are queued and periodically \
+    submitted in bulk by a background thread.
+
+    If `max_pending_pushes` is positive, a background thread collects the push events which \
+    arrive within `PUSH_BATCH_WINDOW` seconds (up to `PUSH_BATCH_SIZE`) and groups them by \
+    repository. The groups run in parallel in the handlers pool if `inline_handlers` is False, \
+    otherwise one after another in the background thread.
     """
 
-    def __init__(self, address: str, handlers: EventHandlers, n_workers: int=1):
+    METRICS_FLUSH_INTERVAL = 0.05  # seconds
+    METRICS_QUEUE_SIZE = 1 << 16
+    PUSH_BATCH_WINDOW = 0.1  # seconds
+    PUSH_BATCH_SIZE = 16
+
+    def __init__(self, address: str, handlers: EventHandlers, n_workers: int=1,
+                 queue_size: Optional[int]=None, inline_handlers: bool=True,
+                 n_handler_workers: Optional[int]=None, max_pending_pushes: int=0):
         """
         Initialize a new instance of EventListener.
 
         :param address: GRPC endpoint to connect to.
         :param handlers: Event callbacks which actually do the real work.
-        :param n_workers: Number of threads in the thread pool which processes incoming events.
+        :param n_workers: Number of threads in the thread pool which processes incoming events. \
+                          Set it to about `os.cpu_count()` for CPU-bound analyzers and higher \
+                          for I/O-bound ones.
+        :param queue_size: Number of incoming events which may wait for a free worker thread \
+                           before the new ones are rejected with RESOURCE_EXHAUSTED. \
+                           The default is 4 * n_workers.
+        :param inline_handlers: Invoke the event callbacks directly in the gRPC worker threads. \
+                                Otherwise, they are offloaded to a separate thread pool, which \
+                                keeps the gRPC threads responsive when the callbacks are heavy.
+        :param n_handler_workers: Number of threads in the pool which runs the event callbacks \
+                                  if `inline_handlers` is False. The default is the number of \
+                                  CPU cores.
+        :param max_pending_pushes: Number of push events which may be acknowledged before \
+                                   they are processed in the background, including the ones \
+                                   in progress; the excess ones are rejected with \
+                                   RESOURCE_EXHAUSTED. 0 means that push events are answered \
+                                   after they are processed.
         """
-        self._server = grpc.server(ThreadPoolExecutor(max_workers=n_workers),
-                                   maximum_concurrent_rpcs=n_workers)
-        self._server.address = address
-        self._server.n_workers = n_workers
+        if queue_size is None:
+            queue_size = 4 * n_workers
+        self._address = address
+        self._n_workers = n_workers
+        self._pool = ThreadPoolExecutor(max_workers=n_workers)
+        self._server = grpc.server(self._pool, maximum_concurrent_rpcs=n_workers + queue_size,
+                                   options=[
+                                       ("grpc.max_send_message_length", grpc_max_msg_size),
+                                       ("grpc.max_receive_message_length", grpc_max_msg_size),
+                                   ])
+        if inline_handlers:
+            self._handler_pool = None
+        else:
+            self._n_handler_workers = n_handler_workers or os.cpu_count() or 1
+            self._handler_pool = ThreadPoolExecutor(max_workers=self._n_handler_workers)
+        if max_pending_pushes > 0:
+            self._push_queue = Queue()
+            self._pending_pushes = BoundedSemaphore(max_pending_pushes)
+        else:
+            self._push_queue = self._pending_pushes = None
+        self._push_batcher = None
+        self._push_batcher_stop_event = Event()
         add_AnalyzerServicer_to_server(self, self._server)
         self.handlers = handlers
+        self._process_push_batch = getattr(handlers, "process_push_event_batch", None)
+        # request type -> (type name, metric key, logging context extractor, callback,
+        #                  whether to process in the background)
+        self._dispatch = {
+            event_type: (event_type.__name__, "request." + event_type.__name__,
+                         request_log_context_extractors[event_type], process, detached)
+            for event_type, process, detached in (
+                (ReviewEvent, handlers.process_review_event, False),
+                (PushEvent, handlers.process_push_event, max_pending_pushes > 0))
+        }
         self._server.add_insecure_port(address)
         self._stop_event = Event()
+        self._metrics_queue = deque(maxlen=self.METRICS_QUEUE_SIZE)
+        self._metrics_stop_event = Event()
+        self._metrics_thread = None
+        # stop the background threads if the listener is garbage collected without stop()
+        weakref.finalize(self, self._signal_threads_stop, self._metrics_stop_event,
+                         self._push_batcher_stop_event, self._push_queue)
         self._log = logging.getLogger(type(self).__name__)
 
     def __str__(self) -> str:
         """Summarize the instance of EventListener as a string."""
-        return "EventListener(%s, %d workers)" % (self._server.address, self._server.n_workers)
+        return "EventListener(%s, %d workers)" % (self._address, self._n_workers)
 
     def start(self):
         """
@@ -105,9 +210,67 @@ class EventListener(AnalyzerServicer):
 
         :return: self
         """
+        self._prewarm_pool(self._pool, self._n_workers)
+        if self._handler_pool is not None:
+            self._prewarm_pool(self._handler_pool, self._n_handler_workers)
+        self._metrics_stop_event.clear()
+        # the threads must not reference self, otherwise the listener is never garbage collected
+        self._metrics_thread = Thread(
+            target=self._flush_metrics, name="metrics", daemon=True,
+            args=(self._metrics_queue, self._metrics_stop_event, self.METRICS_FLUSH_INTERVAL,
+                  self._log))
+        self._metrics_thread.start()
+        if self._push_queue is not None:
+            self._push_batcher_stop_event.clear()
+            self._push_batcher = Thread(
+                target=self._batch_pushes, name="push-batcher", daemon=True,
+                args=(weakref.ref(self), self._push_queue, self._push_batcher_stop_event,
+                      self.PUSH_BATCH_WINDOW, self.PUSH_BATCH_SIZE))
+            self._push_batcher.start()
         self._server.start()
         return self
 
+    @staticmethod
+    def _prewarm_pool(pool: ThreadPoolExecutor, n_threads: int):
+        """
+        Spawn all the worker threads in advance so that the first events do not pay for that.
+
+        ThreadPoolExecutor reuses idle threads, so each task waits until every other one has \
+        started - this forces a separate thread per task.
+        """
+        barrier = Barrier(n_threads)
+        for _ in range(n_threads):
+            pool.submit(barrier.wait, 1)
+
+    @staticmethod
+    def _signal_threads_stop(metrics_stop_event: Event, push_batcher_stop_event: Event,
+                             push_queue: Optional[Queue]):
+        """Ask the background threads to exit. Does not reference the listener."""
+        metrics_stop_event.set()
+        push_batcher_stop_event.set()
+        if push_queue is not None:
+            push_queue.put(None)
+
+    @staticmethod
+    def _flush_metrics(queue: deque, stop_event: Event, interval: float, log: logging.Logger):
+        """
+        Submit the queued metrics every `interval` seconds until `stop_event` is set.
+
+        Each event is still recorded separately since the counters track the number of events \
+        and the sum of squares besides the sum.
+        """
+        stopped = False
+        while not stopped:
+            stopped = stop_event.wait(interval)
+            if len(queue) == queue.maxlen:
+                log.warning("the metrics queue is full, the oldest events may have been lost")
+            while queue:
+                key, value = queue.popleft()
+                try:
+                    record_event(key, value)
+                except Exception:
+                    log.exception("failed to record %s", key)
+
     def block(self):
         """
         Block the calling thread until a KeyboardInterrupt is triggered.
@@ -124,124 +287,218 @@ class EventListener(AnalyzerServicer):
         """
         Force the gRPC server to terminate.
 
+        Unless `cancel_running` is True, waits for the batch of background push events which \
+        is being processed to finish; the queued ones are dropped.
+
         :param cancel_running: If True, performs a very impolite and sudden termination of all \
-                               the threads in the thread pool.
+                               the threads in the thread pool and abandons the background push \
+                               events together with their metrics.
         :return: None
         """
         self._stop_event.set()
         self._server.stop(None if cancel_running else 0)
+        if self._push_batcher is not None:
+            self._push_batcher_stop_event.set()
+            self._push_queue.put(None)
+            if not cancel_running:
+                # the batcher uses the handlers pool and the metrics
+                self._push_batcher.join()
+            self._push_batcher = None
+        if self._handler_pool is not None:
+            self._handler_pool.shutdown(wait=False)
+        if self._metrics_thread is not None:
+            self._metrics_stop_event.set()
+            self._metrics_thread.join()
+            self._metrics_thread = None
 
-    def timeit(func):  # noqa: D401
+    def NotifyReviewEvent(self, request: ReviewEvent, context: grpc.ServicerContext) \
+            -> EventResponse:  # noqa: D401
         """
-        Decorator which measures the elapsed time via `time.perf_counter()`.
+        Fired on `ReviewEvent`-s. Returns `EventResponse`. See \
+        lookout/core/server/sdk/event.proto and lookout/core/server/sdk/service_analyzer.proto.
 
-        :return: The decorated function.
+        Called in a thread from the thread pool.
         """
-        @functools.wraps(func)
-        def wrapped_timeit(self, request, context: grpc.ServicerContext):
-            start_time = time.perf_counter()
-            context.start_time = start_time
-            result = func(self, request, context)
-            if not getattr(context, "error", False):
-                delta = time.perf_counter() - start_time
-                record_event("request." + type(request).__name__, delta)
-                self._log.info("OK %.3f", delta)
-            return result
-
-        return wrapped_timeit
+        return self._process_event(request, context)
 
-    def set_logging_context(func):
+    def NotifyPushEvent(self, request: PushEvent, context: grpc.ServicerContext) \
+            -> EventResponse:  # noqa: D401
         """
-        Assign the metadata of the current gRPC call to the thread-local logging context. \
-        Thus it is associated with the running thread in the pool until a new event is fired.
+        Fired on `PushEvent`-s. Returns nothing - we are not supposed to answer anything.
 
-        :return: The decorated function.
+        Called in a thread from the thread pool. If `max_pending_pushes` is positive, the event \
+        is queued and acknowledged before it is processed.
         """
-        @functools.wraps(func)
-        def wrapped_set_logging_context(self, request, context: grpc.ServicerContext):
-            obj = request_log_context_extractors[type(request)](request)
-            meta = {}
-            for md in context.invocation_metadata():
-                meta[md.key] = md.value
-            obj["meta"] = meta
-            obj["peer"] = context.peer()
-            slogging.set_context(obj)
-            self._log.info("new %s", type(request).__name__)
-            return func(self, request, context)
+        return self._process_event(request, context)
+
+    def _process_event(self, request, context: grpc.ServicerContext,
+                       set_context=slogging.set_context,
+                       structured_logging_enabled=slogging.structured_logging_enabled,
+                       status_internal=grpc.StatusCode.INTERNAL,
+                       status_resource_exhausted=grpc.StatusCode.RESOURCE_EXHAUSTED,
+                       empty_response=_EMPTY_RESPONSE) -> EventResponse:
+        """
+        Run the event callback with all the bells and whistles.
 
-        return wrapped_set_logging_context
+        This is the whole per-call pipeline: assign the metadata of the current gRPC call to \
+        the thread-local logging context, invoke the callback through `_timed_call()` and \
+        convert any exception to a nicer gRPC error message.
 
-    def log_exceptions(func):
+        The keyword arguments are not supposed to be passed: they bind the module-level \
+        objects used on every call to fast local variables.
         """
-        Perform the top-level exception handling. In case of an error, catch it gracefully \
-        and convert to a nicer gRPC error message.
+        name, metric_key, extract_context, process, detached = self._dispatch[type(request)]
+        if structured_logging_enabled():
+            obj = extract_context(request)
+            obj["meta"] = {md.key: md.value for md in context.invocation_metadata()}
+            obj["peer"] = context.peer()
+            set_context(obj)
+        else:
+            # set_context() is a no-op without structured logging
+            obj = None
+        try:
+            if detached:
+                self._enqueue_push(obj, request)
+                return empty_response
+            if self._handler_pool is None:
+                return self._timed_call(name, metric_key, process, request)
+            return self._handler_pool.submit(
+                self._run_handler, obj, name, metric_key, process, request).result()
+        except TooManyPendingEventsError as e:
+            self._log.warning("%s REJECTED: %s", name, e)
+            context.set_code(status_resource_exhausted)
+            context.set_details(str(e))
+            self._metrics_queue.append(("rejected", 1))
+            return empty_response
+        except Exception as e:
+            # already logged and counted by _timed_call()
+            context.set_code(status_internal)
+            context.set_details("%s: %s" % (type(e), e))
+            return empty_response
+
+    def _timed_call(self, name: str, metric_key: str, func: Callable, *args,
+                    clock=_clock, clock_scale=_CLOCK_SCALE):
+        """
+        Invoke `func(*args)`, log the outcome together with the elapsed time and record it \
+        in the metrics. The exceptions are logged, counted and raised again.
 
-        :return: The decorated function.
+        `clock` and `clock_scale` are not supposed to be passed: they bind the module-level \
+        objects to fast local variables.
         """
-        @functools.wraps(func)
-        def wrapped_catch_them_all(self, request, context: grpc.ServicerContext):
-            try:
-                return func(self, request, context)
-            except Exception as e:
-                start_time = getattr(context, "start_time", None)
-                if start_time is not None:
-                    delta = time.perf_counter() - start_time
-                    self._log.exception("FAIL %.3f", delta)
-                else:
-                    self._log.exception("FAIL ?")
-                context.set_code(grpc.StatusCode.INTERNAL)
-                context.set_details("%s: %s" % (type(e), e))
-                context.error = True
-                record_event("error", 1)
-                return EventResponse()
-
-        return wrapped_catch_them_all
-
-    def handle(func):
-        """
-        Run the corresponding callback from `handlers`.
-
-        :return: The decorated function.
-        """
-        @functools.wraps(func)
-        def wrapped_handle(self, request, context: grpc.ServicerContext):
-            method_name = "process_" + stringcase.snakecase(type(request).__name__)
-            return getattr(self.handlers, method_name)(request)
-
-        return wrapped_handle
-
-    @set_logging_context
-    @timeit
-    @log_exceptions
-    @handle
-    def NotifyReviewEvent(self, request: ReviewEvent, context: grpc.ServicerContext) \
-            -> EventResponse:  # noqa: D401
+        start_time = clock()
+        try:
+            result = func(*args)
+        except Exception:
+            self._log.exception("%s FAIL %.3f", name, (clock() - start_time) * clock_scale)
+            self._metrics_queue.append(("error", 1))
+            raise
+        delta = (clock() - start_time) * clock_scale
+        self._metrics_queue.append((metric_key, delta))
+        self._log.info("%s OK %.3f", name, delta)
+        return result
+
+    def _run_handler(self, log_context: Optional[Dict[str, Any]], name: str, metric_key: str,
+                     process: Callable[[Any], EventResponse], request) -> EventResponse:
+        """Invoke the event callback in the handlers pool under the caller's logging context."""
+        slogging.set_context(log_context)
+        return self._timed_call(name, metric_key, process, request)
+
+    def _enqueue_push(self, log_context: Optional[Dict[str, Any]], request: PushEvent):
         """
-        Fired on `ReviewEvent`-s. Returns `EventResponse`. See \
-        lookout/core/server/sdk/event.proto and lookout/core/server/sdk/service_analyzer.proto.
-
-        The actual result is returned in `handle()` decorator.
+        Schedule the push event to be processed by the batcher thread.
 
-        Called in a thread from the thread pool.
+        :raise TooManyPendingEventsError: if `max_pending_pushes` events are already pending.
         """
-        pass
+        if not self._pending_pushes.acquire(blocking=False):
+            raise TooManyPendingEventsError("PushEvent: too many events are already pending")
+        self._push_queue.put((log_context, request))
 
-    @set_logging_context
-    @timeit
-    @log_exceptions
-    @handle
-    def NotifyPushEvent(self, request: PushEvent, context: grpc.ServicerContext) \
-            -> EventResponse:  # noqa: D401
+    @staticmethod
+    def _batch_pushes(listener_ref: weakref.ref, queue: Queue,
+                      stop_event: Event, window: float, size: int):
         """
-        Fired on `PushEvent`-s. Returns nothing - we are not supposed to answer anything.
+        Collect the queued push events in batches and process them until stopped.
 
-        The actual work is done in `handle()` decorator.
-
-        Called in a thread from the thread pool.
+        A batch starts with the first event which arrives and lasts for `window` seconds or \
+        until `size` events are collected. The listener is referenced weakly so that the \
+        thread does not keep it alive.
+        """
+        while not stop_event.is_set():
+            item = queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + window
+            while len(batch) < size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = queue.get(timeout=timeout)
+                except Empty:
+                    break
+                if item is None:
+                    stop_event.set()
+                    break
+                batch.append(item)
+            listener = listener_ref()
+            if listener is None:
+                return
+            listener._process_pushes(batch)
+            del listener
+        listener = listener_ref()
+        if listener is None:
+            return
+        dropped = 0
+        while True:
+            try:
+                item = queue.get_nowait()
+            except Empty:
+                break
+            if item is not None:
+                dropped += 1
+                listener._pending_pushes.release()
+        if dropped > 0:
+            listener._log.warning("dropped %d pending PushEvent-s", dropped)
+
+    def _process_pushes(self, batch: List[Tuple[Optional[Dict[str, Any]], PushEvent]]):
+        """Process the batch of push events grouped by repository."""
+        groups = OrderedDict()
+        for log_context, request in batch:
+            url = request.commit_revision.head.internal_repository_url
+            groups.setdefault(url, []).append((log_context, request))
+        if self._handler_pool is None:
+            for items in groups.values():
+                self._process_push_group(items)
+        else:
+            wait_futures([self._handler_pool.submit(self._process_push_group, items)
+                          for items in groups.values()])
+
+    def _process_push_group(self, items: List[Tuple[Optional[Dict[str, Any]], PushEvent]],
+                            set_context=slogging.set_context):
         """
-        pass
+        Process the push events which belong to the same repository.
 
-    timeit = staticmethod(timeit)
-    set_logging_context = staticmethod(set_logging_context)
-    log_exceptions = staticmethod(log_exceptions)
-    handle = staticmethod(handle)
+        The failures are logged and counted by `_timed_call()`: the events were acknowledged \
+        already, so there is nobody to report them to.
+        """
+        name, metric_key, _, process, _ = self._dispatch[PushEvent]
+        try:
+            if self._process_push_batch is not None:
+                # the newest event represents the whole group in the logs
+                set_context(items[-1][0])
+                try:
+                    self._timed_call("%d %s-s" % (len(items), name), metric_key + ".batch",
+                                     self._process_push_batch, [r for _, r in items])
+                except Exception:
+                    pass
+            else:
+                for log_context, request in items:
+                    set_context(log_context)
+                    try:
+                        self._timed_call(name, metric_key, process, request)
+                    except Exception:
+                        pass
+        finally:
+            for _ in items:
+                self._pending_pushes.release()
@@ -1 +1,10 @@
+import logging
+
 from modelforge.slogging import *  # noqa
+from modelforge.slogging import StructuredHandler
+
+
+def structured_logging_enabled() -> bool:
+    """Check whether the logging context assigned with `set_context()` is going to be used."""
+    handlers = logging.getLogger().handlers
+    return bool(handlers) and isinstance(handlers[0], StructuredHandler)
@@ -1,8 +1,16 @@
+import logging
 import os
+import threading
+import time
 import unittest
+from unittest.mock import patch
 
+import grpc
+
+from lookout.core import slogging
 from lookout.core.api.event_pb2 import PushEvent, ReviewEvent
 from lookout.core.api.service_analyzer_pb2 import EventResponse
+from lookout.core.api.service_analyzer_pb2_grpc import AnalyzerStub
 from lookout.core.event_listener import EventHandlers, EventListener
 from lookout.core.helpers.server import find_port, LookoutSDK
 
@@ -10,6 +18,7 @@ from lookout.core.helpers.server import find_port, LookoutSDK
 class Handlers(EventHandlers):
     def __init__(self):
         self.request = None
+        self.processed = threading.Event()
 
     def process_review_event(self, request: ReviewEvent) -> EventResponse:
         self.request = request
@@ -17,9 +26,28 @@ class Handlers(EventHandlers):
 
     def process_push_event(self, request: PushEvent) -> EventResponse:
         self.request = request
+        self.processed.set()
         return EventResponse()
 
 
+class FakeContext:
+    def __init__(self):
+        self.code = None
+        self.details = None
+
+    def invocation_metadata(self):
+        return []
+
+    def peer(self):
+        return "test"
+
+    def set_code(self, code):
+        self.code = code
+
+    def set_details(self, details):
+        self.details = details
+
+
 class EventListenerTests(unittest.TestCase):
     COMMIT_FROM = "3ac2a59275902f7252404d26680e30cc41efb837"
     COMMIT_TO = "dce7fcba3d2151a0d5dc4b3a89cfc0911c96cf2b"
@@ -35,7 +63,72 @@ class EventListenerTests(unittest.TestCase):
         self.lookout_sdk.review(self.COMMIT_FROM, self.COMMIT_TO, self.port,
                                 git_dir=os.getenv("LOOKOUT_SDK_ML_TESTS_GIT_DIR", "."))
         self.assertIsInstance(self.handlers.request, ReviewEvent)
-        del listener
+        listener.stop()
+
+    def test_review_queue(self):
+        start_time = time.monotonic()
+        listener = EventListener("localhost:%d" % self.port, self.handlers,
+                                 n_workers=3, queue_size=2).start()
+        self.assertLess(time.monotonic() - start_time, 1)
+        self.assertEqual(len(listener._pool._threads), 3)
+        self.lookout_sdk.review(self.COMMIT_FROM, self.COMMIT_TO, self.port,
+                                git_dir=os.getenv("LOOKOUT_SDK_ML_TESTS_GIT_DIR", "."))
+        self.assertIsInstance(self.handlers.request, ReviewEvent)
+        listener.stop()
+
+    def test_review_queue_full(self):
+        gate = threading.Event()
+
+        class BlockingHandlers(Handlers):
+            def process_review_event(self, request: ReviewEvent) -> EventResponse:
+                gate.wait(10)
+                return super().process_review_event(request)
+
+        listener = EventListener("localhost:%d" % self.port, BlockingHandlers(),
+                                 n_workers=1, queue_size=2).start()
+        channel = grpc.insecure_channel("localhost:%d" % self.port)
+        try:
+            grpc.channel_ready_future(channel).result(timeout=10)
+            stub = AnalyzerStub(channel)
+            accepted = []
+            for _ in range(3):
+                accepted.append(stub.NotifyReviewEvent.future(ReviewEvent()))
+                time.sleep(0.2)
+            rejected = stub.NotifyReviewEvent.future(ReviewEvent())
+            self.assertEqual(rejected.exception(timeout=10).code(),
+                             grpc.StatusCode.RESOURCE_EXHAUSTED)
+            gate.set()
+            for future in accepted:
+                self.assertIsInstance(future.result(timeout=10), EventResponse)
+        finally:
+            gate.set()
+            channel.close()
+            listener.stop()
+
+    def test_review_offloaded(self):
+        class ContextHandlers(Handlers):
+            def process_review_event(self, request: ReviewEvent) -> EventResponse:
+                self.log_context = getattr(logging.getLogger().handlers[0].local, "context",
+                                           None)
+                self.thread = threading.current_thread()
+                return super().process_review_event(request)
+
+        self.handlers = ContextHandlers()
+        logging.basicConfig()
+        handler_backup = logging.getLogger().handlers[0]
+        slogging.setup("INFO", True)
+        try:
+            listener = EventListener("localhost:%d" % self.port, self.handlers,
+                                     inline_handlers=False, n_handler_workers=1).start()
+            self.lookout_sdk.review(self.COMMIT_FROM, self.COMMIT_TO, self.port,
+                                    git_dir=os.getenv("LOOKOUT_SDK_ML_TESTS_GIT_DIR", "."))
+            listener.stop()
+        finally:
+            logging.getLogger().handlers[0] = handler_backup
+        self.assertIsInstance(self.handlers.request, ReviewEvent)
+        self.assertIn(self.handlers.thread, listener._handler_pool._threads)
+        self.assertEqual(self.handlers.log_context["type"], "ReviewEvent")
+        self.assertEqual(self.handlers.log_context["commit_head"], self.COMMIT_TO)
 
     def test_push(self):
         listener = EventListener("localhost:%d" % self.port,
@@ -43,7 +136,153 @@ class EventListenerTests(unittest.TestCase):
         self.lookout_sdk.push(self.COMMIT_FROM, self.COMMIT_TO, self.port,
                               git_dir=os.getenv("LOOKOUT_SDK_ML_TESTS_GIT_DIR", "."))
         self.assertIsInstance(self.handlers.request, PushEvent)
-        del listener
+        listener.stop()
+
+    def test_push_detached(self):
+        listener = EventListener("localhost:%d" % self.port,
+                                 self.handlers, max_pending_pushes=1).start()
+        self.lookout_sdk.push(self.COMMIT_FROM, self.COMMIT_TO, self.port,
+                              git_dir=os.getenv("LOOKOUT_SDK_ML_TESTS_GIT_DIR", "."))
+        self.assertTrue(self.handlers.processed.wait(10))
+        self.assertIsInstance(self.handlers.request, PushEvent)
+        listener.stop()
+
+
+class EventListenerMetricsTests(unittest.TestCase):
+    def test_flush(self):
+        listener = EventListener("localhost:%d" % find_port(), Handlers())
+        with patch("lookout.core.event_listener.record_event") as record_event:
+            listener.start()
+            try:
+                listener.NotifyReviewEvent(ReviewEvent(), FakeContext())
+                time.sleep(listener.METRICS_FLUSH_INTERVAL * 10)
+                self.assertEqual(record_event.call_count, 1)
+                self.assertEqual(record_event.call_args[0][0], "request.ReviewEvent")
+                listener.NotifyPushEvent(PushEvent(), FakeContext())
+            finally:
+                listener.stop()
+            self.assertEqual(record_event.call_count, 2)
+            self.assertEqual(record_event.call_args[0][0], "request.PushEvent")
+
+    def test_record_failure(self):
+        listener = EventListener("localhost:%d" % find_port(), Handlers())
+        with patch("lookout.core.event_listener.record_event",
+                   side_effect=[OSError("the port is busy"), None]) as record_event:
+            listener.start()
+            try:
+                listener.NotifyReviewEvent(ReviewEvent(), FakeContext())
+                time.sleep(listener.METRICS_FLUSH_INTERVAL * 10)
+                listener.NotifyReviewEvent(ReviewEvent(), FakeContext())
+            finally:
+                listener.stop()
+            self.assertEqual(record_event.call_count, 2)
+
+
+def make_push_event(url: str, head: str) -> PushEvent:
+    request = PushEvent()
+    request.commit_revision.head.internal_repository_url = url
+    request.commit_revision.head.hash = head
+    return request
+
+
+class BatchHandlers(Handlers):
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+        self.processed = threading.Semaphore(0)
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def process_push_event_batch(self, requests) -> None:
+        self.gate.wait()
+        self.batches.append([r.commit_revision.head.hash for r in requests])
+        for _ in requests:
+            self.processed.release()
+
+
+class EventListenerPushBatchTests(unittest.TestCase):
+    def setUp(self):
+        patcher = patch("lookout.core.event_listener.record_event")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_listener(self, handlers, window, size=EventListener.PUSH_BATCH_SIZE, **kwargs):
+        listener = EventListener("localhost:%d" % find_port(), handlers, **kwargs)
+        listener.PUSH_BATCH_WINDOW = window
+        listener.PUSH_BATCH_SIZE = size
+        self.addCleanup(listener.stop)
+        return listener.start()
+
+    def push(self, listener, url, head):
+        context = FakeContext()
+        listener.NotifyPushEvent(make_push_event(url, head), context)
+        return context
+
+    def wait_processed(self, handlers, count):
+        for _ in range(count):
+            self.assertTrue(handlers.processed.acquire(timeout=10))
+
+    def test_grouping(self):
+        for inline_handlers in (True, False):
+            handlers = BatchHandlers()
+            listener = self.create_listener(handlers, 0.5, max_pending_pushes=10,
+                                            inline_handlers=inline_handlers)
+            for url, head in (("a", "a1"), ("b", "b1"), ("a", "a2")):
+                self.assertIsNone(self.push(listener, url, head).code)
+            self.wait_processed(handlers, 3)
+            self.assertEqual(sorted(handlers.batches), [["a1", "a2"], ["b1"]])
+
+    def test_window(self):
+        handlers = BatchHandlers()
+        listener = self.create_listener(handlers, 0.05, max_pending_pushes=10)
+        self.push(listener, "a", "a1")
+        self.wait_processed(handlers, 1)
+        self.push(listener, "a", "a2")
+        self.wait_processed(handlers, 1)
+        self.assertEqual(handlers.batches, [["a1"], ["a2"]])
+
+    def test_batch_size(self):
+        handlers = BatchHandlers()
+        listener = self.create_listener(handlers, 0.5, size=2, max_pending_pushes=10)
+        for head in ("a1", "a2", "a3"):
+            self.push(listener, "a", head)
+        self.wait_processed(handlers, 3)
+        self.assertEqual(handlers.batches, [["a1", "a2"], ["a3"]])
+
+    def test_failure_does_not_drop_events(self):
+        class FailingHandlers(Handlers):
+            def __init__(self):
+                super().__init__()
+                self.heads = []
+
+            def process_push_event(self, request: PushEvent) -> EventResponse:
+                if request.commit_revision.head.hash == "bad":
+                    raise ValueError("bad")
+                self.heads.append(request.commit_revision.head.hash)
+                if request.commit_revision.head.hash == "c":
+                    self.processed.set()
+                return EventResponse()
+
+        handlers = FailingHandlers()
+        listener = self.create_listener(handlers, 0.5, max_pending_pushes=10)
+        for head in ("a", "bad", "c"):
+            self.push(listener, "a", head)
+        self.assertTrue(handlers.processed.wait(10))
+        self.assertEqual(handlers.heads, ["a", "c"])
+
+    def test_queue_full(self):
+        handlers = BatchHandlers()
+        handlers.gate.clear()
+        listener = self.create_listener(handlers, 0.01, max_pending_pushes=2)
+        codes = []
+        for head in ("a1", "a2", "a3"):
+            codes.append(self.push(listener, "a", head).code)
+            time.sleep(0.05)
+        self.assertEqual(codes, [None, None, grpc.StatusCode.RESOURCE_EXHAUSTED])
+        handlers.gate.set()
+        self.wait_processed(handlers, 2)
+        self.assertIsNone(self.push(listener, "a", "a4").code)
+        self.wait_processed(handlers, 1)
 
 
 if __name__ == "__main__":
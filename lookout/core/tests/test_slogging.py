@@ -27,6 +27,17 @@ class SloggingTests(unittest.TestCase):
         self.assertEqual(len(obj["thread"]), 4)
         self.assertIn("time", obj)
 
+    def test_structured_logging_enabled(self):
+        logging.basicConfig()
+        handler_backup = logging.getLogger().handlers[0]
+        try:
+            logging.getLogger().handlers[0] = logging.StreamHandler()
+            self.assertFalse(slogging.structured_logging_enabled())
+            slogging.setup("INFO", True)
+            self.assertTrue(slogging.structured_logging_enabled())
+        finally:
+            logging.getLogger().handlers[0] = handler_backup
+
     def test_config(self):
         slogging.setup("INFO", True, "XXX.yml")
         with tempfile.NamedTemporaryFile() as f: